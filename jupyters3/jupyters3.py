@@ -1,8 +1,25 @@
+"""Jupyter contents manager that stores notebooks and files in S3.
+
+Most of the time of each operation is spent waiting on S3 rather than in
+Python, so the S3 requests are made:
+
+- over kept-alive connections if pycurl is installed, by a single curl
+  HTTP client that runs on a persistent event loop thread, so TLS setup
+  happens once rather than per request. pycurl isn't a dependency, and
+  without it each request opens its own connection;
+- concurrently where they are independent, such as when checking
+  existence, copying directories, and paginating listings;
+- batched where S3 allows, such as deleting up to 1000 keys per request.
+
+Signing each request is cheap in comparison, and its caching is secondary.
+"""
 import asyncio
 import base64
 from collections import namedtuple
 import datetime
+import functools
 import hashlib
+import heapq
 import hmac
 import itertools
 import json
@@ -10,9 +27,23 @@ import mimetypes
 import os
 import threading
 import re
+import sys
 import time
 import urllib
-import xml.etree.ElementTree as ET
+import weakref
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+# Only for credentials: orjson rejects NaN and Infinity, writes them as null,
+# and reads integers over 64 bits as floats, so isn't used for notebooks
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    def _json_loads(json_bytes):
+        return json.loads(json_bytes.decode('utf-8'))
 
 from tornado import gen
 from tornado.httpclient import (
@@ -20,8 +51,19 @@ from tornado.httpclient import (
     HTTPError as HTTPClientError,
     HTTPRequest,
 )
+
+# libcurl reuses connections, including their TLS sessions, across requests,
+# but needs pycurl, which isn't a Jupyter dependency. Tornado's own client
+# closes each connection after its request
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as HTTPClient
+    HTTP_CLIENT_REUSES_CONNECTIONS = True
+except ImportError:
+    HTTPClient = AsyncHTTPClient
+    HTTP_CLIENT_REUSES_CONNECTIONS = False
+
 from tornado.ioloop import IOLoop
-from tornado.locks import Lock
+from tornado.locks import Lock, Semaphore
 from tornado.web import HTTPError as HTTPServerError
 from traitlets.config.configurable import Configurable
 from traitlets import (
@@ -31,6 +73,7 @@ from traitlets import (
     TraitType,
     Type,
     default,
+    observe,
 )
 
 import nbformat
@@ -45,6 +88,38 @@ CHECKPOINT_SUFFIX = '.checkpoints'
 UNTITLED_NOTEBOOK = 'Untitled'
 UNTITLED_FILE = 'Untitled'
 UNTITLED_DIRECTORY  = 'Untitled Folder'
+DIRECTORY_LAST_MODIFIED = datetime.datetime.fromtimestamp(86400)
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+# Bulk operations fan out, but not so much to hit S3 request rate limits
+MAX_CONCURRENT_REQUESTS = 32
+MAX_DELETE_KEYS = 1000
+
+# Large objects are copied in parts, several at once, rather than in a
+# single request. This is also the only way to copy objects over 5GB
+MULTIPART_COPY_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_COPY_PART_SIZE = 64 * 1024 * 1024
+MAX_CONCURRENT_PART_COPIES = 16
+MAX_MULTIPART_PARTS = 10000
+
+# Refresh temporary credentials a bit before they expire, rather than
+# risk them expiring between signing a request and S3 receiving it
+CREDENTIALS_EXPIRY_MARGIN = datetime.timedelta(seconds=60)
+
+# S3 asks clients to retry on 5xx responses, for example 503 Slow Down, and
+# 599 is Tornado's code for a timeout
+RETRY_CODES = (500, 502, 503, 504, 599)
+MAX_RETRIES = 3
+
+# Other than 503, S3 may have handled a failed request, so those that
+# aren't safe to repeat are retried only on 503
+NON_IDEMPOTENT_RETRY_CODES = (503,)
+
+HTTP_CLIENT_MAX_CLIENTS = 128
+HTTP_CLIENT_DEFAULTS = {
+    'connect_timeout': 3,
+    'request_timeout': 30,
+}
 
 Context = namedtuple('Context', [
     'logger', 'prefix', 'region', 's3_bucket', 's3_host', 's3_auth',
@@ -60,23 +135,28 @@ class ExpiringDict:
     def __init__(self, seconds):
         self._seconds = seconds
         self._store = {}
+        # (expires, key) of every set. Entries of keys that have since been
+        # set again or deleted are skipped when popped
+        self._expiries = []
 
     def _remove_old_keys(self, now):
-        self._store = {
-            key: (expires, value)
-            for key, (expires, value) in self._store.items()
-            if expires > now
-        }
+        while self._expiries and self._expiries[0][0] <= now:
+            expires, key = heapq.heappop(self._expiries)
+            if key in self._store and self._store[key][0] == expires:
+                del self._store[key]
 
     def __getitem__(self, key):
         now = int(time.time())
-        self._remove_old_keys(now)
-        return self._store[key][1]
+        expires, value = self._store[key]
+        if expires <= now:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
         now = int(time.time())
         self._remove_old_keys(now)
         self._store[key] = (now + self._seconds, value)
+        heapq.heappush(self._expiries, (now + self._seconds, key))
 
     def __delitem__(self, key):
         now = int(time.time())
@@ -100,14 +180,22 @@ class JupyterS3SecretAccessKeyAuthentication(JupyterS3Authentication):
     aws_access_key_id = Unicode(config=True)
     aws_secret_access_key = Unicode(config=True)
     pre_auth_headers = Dict()
+    credentials = None
+
+    @observe('aws_access_key_id', 'aws_secret_access_key', 'pre_auth_headers')
+    def _clear_credentials(self, change):
+        self.credentials = None
 
     @gen.coroutine
     def get_credentials(self):
-        return AwsCreds(
-            access_key_id=self.aws_access_key_id,
-            secret_access_key=self.aws_secret_access_key,
-            pre_auth_headers=self.pre_auth_headers,
-        )
+        if self.credentials is None:
+            self.credentials = AwsCreds(
+                access_key_id=self.aws_access_key_id,
+                secret_access_key=self.aws_secret_access_key,
+                pre_auth_headers=self.pre_auth_headers,
+            )
+
+        return self.credentials
 
 
 class JupyterS3ECSRoleAuthentication(JupyterS3Authentication):
@@ -116,26 +204,28 @@ class JupyterS3ECSRoleAuthentication(JupyterS3Authentication):
     aws_secret_access_key = Unicode()
     pre_auth_headers = Dict()
     expiration = Datetime()
+    credentials = None
 
     @gen.coroutine
     def get_credentials(self):
         now = datetime.datetime.now()
 
-        if now > self.expiration:
+        if now > self.expiration - CREDENTIALS_EXPIRY_MARGIN:
             request = HTTPRequest('http://169.254.170.2' + os.environ['AWS_CONTAINER_CREDENTIALS_RELATIVE_URI'], method='GET')
-            creds = json.loads((yield AsyncHTTPClient().fetch(request)).body.decode('utf-8'))
+            creds = _json_loads((yield _fetch(request)).body)
             self.aws_access_key_id = creds['AccessKeyId']
             self.aws_secret_access_key = creds['SecretAccessKey']
             self.pre_auth_headers = {
                 'x-amz-security-token': creds['Token'],
             }
             self.expiration = datetime.datetime.strptime(creds['Expiration'], '%Y-%m-%dT%H:%M:%SZ')
+            self.credentials = AwsCreds(
+                access_key_id=self.aws_access_key_id,
+                secret_access_key=self.aws_secret_access_key,
+                pre_auth_headers=self.pre_auth_headers,
+            )
 
-        return AwsCreds(
-            access_key_id=self.aws_access_key_id,
-            secret_access_key=self.aws_secret_access_key,
-            pre_auth_headers=self.pre_auth_headers,
-        )
+        return self.credentials
 
 
 class JupyterS3(ContentsManager):
@@ -182,7 +272,7 @@ class JupyterS3(ContentsManager):
         def dir_exists_async():
             return (yield _dir_exists(self._context(), path))
 
-        return _run_sync_in_new_thread(dir_exists_async)
+        return _run_sync_in_loop_thread(dir_exists_async)
 
     def file_exists(self, path):
 
@@ -190,7 +280,7 @@ class JupyterS3(ContentsManager):
         def file_exists_async():
             return (yield _file_exists(self._context(), path))
 
-        return _run_sync_in_new_thread(file_exists_async)
+        return _run_sync_in_loop_thread(file_exists_async)
 
     def get(self, path, content=True, type=None, format=None):
 
@@ -198,12 +288,15 @@ class JupyterS3(ContentsManager):
         def get_async():
             return (yield _get(self._context(), path, content, type, format))
 
-        return _run_sync_in_new_thread(get_async)
+        return _run_sync_in_loop_thread(get_async)
 
     @gen.coroutine
     def save(self, model, path):
+        context = self._context()
+        # Encoding the content doesn't need the lock: only the S3 requests do
+        save_args = yield _prepare_save(context, model, path)
         with (yield self.write_lock.acquire()):
-            return (yield _save(self._context(), model, path))
+            return (yield _save_any(context, *save_args))
 
     @gen.coroutine
     def delete(self, path):
@@ -249,16 +342,29 @@ class JupyterS3(ContentsManager):
         with (yield self.write_lock.acquire()):
             return (yield _delete_checkpoint(self._context(), checkpoint_id, path))
 
+    # The context is built once, rather than on every call, and rebuilt
+    # only if any trait it's built from changes
+    cached_context = None
+
+    @observe(
+        'log', 'aws_region', 'aws_s3_bucket', 'aws_s3_host', 'authentication',
+        'prefix', 'multipart_uploads',
+    )
+    def _clear_context(self, change):
+        self.cached_context = None
+
     def _context(self):
-        return Context(
-            logger=self.log,
-            region=self.aws_region,
-            s3_bucket=self.aws_s3_bucket,
-            s3_host=self.aws_s3_host,
-            s3_auth=self.authentication.get_credentials,
-            prefix=self.prefix,
-            multipart_uploads=self.multipart_uploads,
-        )
+        if self.cached_context is None:
+            self.cached_context = Context(
+                logger=self.log,
+                region=self.aws_region,
+                s3_bucket=self.aws_s3_bucket,
+                s3_host=self.aws_s3_host,
+                s3_auth=self.authentication.get_credentials,
+                prefix=self.prefix,
+                multipart_uploads=self.multipart_uploads,
+            )
+        return self.cached_context
 
 
 # The documentation suggests that leading slashes in the
@@ -267,12 +373,42 @@ def _key(context, path):
     return context.prefix + path.lstrip('/')
 
 
+def _directory_key_prefix(context, path):
+    key = _key(context, path)
+    return key if (key == '' or key[-1] == '/') else (key + '/')
+
+
 def _path(context, key):
     return '/' + key[len(context.prefix):]
 
 
 def _final_path_component(key_or_path):
-    return key_or_path.split('/')[-1]
+    return key_or_path[key_or_path.rfind('/') + 1:]
+
+
+# The timestamps from S3 have fixed formats, so are sliced rather
+# than parsed with strptime, which is slow
+def _datetime_from_iso_8601(timestamp):
+    # For example 2009-10-12T17:50:30.123Z
+    return datetime.datetime(
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+        int(timestamp[20:-1].ljust(6, '0')),
+    )
+
+
+HTTP_DATE_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+
+def _datetime_from_http_date(http_date):
+    # For example Mon, 12 Oct 2009 17:50:00 GMT
+    return datetime.datetime(
+        int(http_date[12:16]), HTTP_DATE_MONTHS[http_date[8:11]], int(http_date[5:7]),
+        int(http_date[17:19]), int(http_date[20:22]), int(http_date[23:25]),
+    )
 
 
 # The sort keys keep the UI as reasonable as possible with long running
@@ -305,6 +441,15 @@ def _format_from_type_and_path(context, type, path):
     return type
 
 
+# As _type_from_path, for when whether the directory exists is already known
+def _type_from_path_and_dir_exists(path, dir_exists):
+    type = \
+        'notebook' if path.endswith(NOTEBOOK_SUFFIX) else \
+        'directory' if dir_exists else \
+        'file'
+    return type
+
+
 def _type_from_path_not_directory(path):
     type = \
         'notebook' if path.endswith(NOTEBOOK_SUFFIX) else \
@@ -325,25 +470,37 @@ def _is_root(path):
 
 @gen.coroutine
 def _file_exists(context, path):
+    return (yield _file_response(context, path)) is not None
+
+
+# The response to a HEAD of the path's key, which has its size, or None if
+# there is no such key
+@gen.coroutine
+def _file_response(context, path):
 
     @gen.coroutine
-    def key_exists():
+    def key_response():
         key = _key(context, path)
         try:
             response = yield _make_s3_request(context, 'HEAD', '/' + key, {}, {}, b'')
         except HTTPClientError as exception:
-            if exception.response.code != 404 and exception.response.code != 403:
-                raise HTTPServerError(exception.response.code, 'Error checking if S3 exists')
-            response = exception.response
+            if exception.code != 404 and exception.code != 403:
+                raise HTTPServerError(exception.code, 'Error checking if S3 exists')
+            return None
 
-        return response.code == 200
+        return response
 
-    return False if _is_root(path) else (yield key_exists())
+    return None if _is_root(path) else (yield key_response())
 
 
 @gen.coroutine
 def _exists(context, path):
-    return (yield _file_exists(context, path)) or (yield _dir_exists(context, path)) 
+    # Each is a single request, independent of the other
+    file_exists, dir_exists = yield gen.multi([
+        _file_exists(context, path),
+        _dir_exists(context, path),
+    ])
+    return file_exists or dir_exists
 
 
 @gen.coroutine
@@ -359,12 +516,9 @@ def _get_notebook(context, path, content):
     return nbformat.from_dict(notebook_dict)
 
 def _clean_json(nb):
-    stringified = ""
     for cell in nb['cells']:
-        for source in cell['source']:
-            stringified = stringified + source
-            cell['source'] = stringified
-        stringified = ""
+        source = cell['source']
+        cell['source'] = ''.join(source) if isinstance(source, list) else source
     return nb
 
 @gen.coroutine
@@ -384,7 +538,7 @@ def _get_any(context, path, content, type, mimetype, format, decode):
     response = yield _make_s3_request(context, method, '/' + key, {}, {}, b'')
     file_bytes = response.body
     last_modified_str = response.headers['Last-Modified']
-    last_modified = datetime.datetime.strptime(last_modified_str, "%a, %d %b %Y %H:%M:%S GMT")
+    last_modified = _datetime_from_http_date(last_modified_str)
     return {
         'name': _final_path_component(path),
         'path': path,
@@ -393,6 +547,7 @@ def _get_any(context, path, content, type, mimetype, format, decode):
         'writable': True,
         'last_modified': last_modified, 
         'created': last_modified,
+        'size': int(response.headers['Content-Length']),
         'format': format if content else None,  
         'content': decode(file_bytes) if content else None,
     }  
@@ -400,13 +555,13 @@ def _get_any(context, path, content, type, mimetype, format, decode):
 
 @gen.coroutine
 def _get_directory(context, path, content):
-    key = _key(context, path)
-    key_prefix = key if (key == '' or key[-1] == '/') else (key + '/')
+    key_prefix = _directory_key_prefix(context, path)
     keys, directories = \
         (yield _list_immediate_child_keys_and_directories(context, key_prefix)) if content else \
         ([], [])
 
-    all_keys = {key for (key, _) in keys}
+    # Files that have checkpoints also appear as directories
+    all_keys = {key for (key, _, _) in keys} if directories else set()
 
     return {
         'name': _final_path_component(path),
@@ -414,8 +569,8 @@ def _get_directory(context, path, content):
         'type': 'directory',
         'mimetype': None,
         'writable': True,
-        'last_modified': datetime.datetime.fromtimestamp(86400), 
-        'created': datetime.datetime.fromtimestamp(86400),
+        'last_modified': DIRECTORY_LAST_MODIFIED,
+        'created': DIRECTORY_LAST_MODIFIED,
         'format': 'json' if content else None,
         'content': ([
             {
@@ -432,7 +587,7 @@ def _get_directory(context, path, content):
                 'path': _path(context, key),
                 'last_modified': last_modified,
             }
-            for (key, last_modified) in keys
+            for (key, last_modified, _) in keys
             if not key.endswith(DIRECTORY_SUFFIX)
         ]) if content else None
     }
@@ -440,34 +595,38 @@ def _get_directory(context, path, content):
 
 @gen.coroutine
 def _save(context, model, path):
+    save_args = yield _prepare_save(context, model, path)
+    return (yield _save_any(context, *save_args))
+
+
+# Returns the arguments of _save_any, without making any requests that change S3
+@gen.coroutine
+def _prepare_save(context, model, path):
     type_to_save = model['type'] if 'type' in model else (yield _type_from_path(context, path))
     format_to_save = model['format'] if 'format' in model else _format_from_type_and_path(context, type_to_save, path)
-    return (yield SAVERS[(type_to_save, format_to_save)](
-        context,
+    return (
         model['chunk'] if 'chunk' in model else None,
-        model['content'] if 'content' in model else None,
-        path,
-    ))
+        *PREPARERS[(type_to_save, format_to_save)](
+            model['content'] if 'content' in model else None,
+            path,
+        ),
+    )
 
 
-@gen.coroutine
-def _save_notebook(context, chunk, content, path):
-    return (yield _save_any(context, chunk, json.dumps(content).encode('utf-8'), path, 'notebook', None))
+def _prepare_notebook(content, path):
+    return (json.dumps(content).encode('utf-8'), path, 'notebook', None)
 
 
-@gen.coroutine
-def _save_file_base64(context, chunk, content, path):
-    return (yield _save_any(context, chunk, base64.b64decode(content.encode('utf-8')), path, 'file', 'application/octet-stream'))
+def _prepare_file_base64(content, path):
+    return (base64.b64decode(content.encode('utf-8')), path, 'file', 'application/octet-stream')
 
 
-@gen.coroutine
-def _save_file_text(context, chunk, content, path):
-    return (yield _save_any(context, chunk, content.encode('utf-8'), path, 'file', 'text/plain'))
+def _prepare_file_text(content, path):
+    return (content.encode('utf-8'), path, 'file', 'text/plain')
 
 
-@gen.coroutine
-def _save_directory(context, chunk, content, path):
-    return (yield _save_any(context, chunk, b'', path + DIRECTORY_SUFFIX, 'directory', None))
+def _prepare_directory(content, path):
+    return (b'', path + DIRECTORY_SUFFIX, 'directory', None)
 
 
 @gen.coroutine
@@ -501,7 +660,7 @@ def _save_bytes(context, content_bytes, path, type, mimetype):
     response = yield _make_s3_request(context, 'PUT', '/' + key, {}, {}, content_bytes)
 
     last_modified_str = response.headers['Date']
-    last_modified = datetime.datetime.strptime(last_modified_str, "%a, %d %b %Y %H:%M:%S GMT")
+    last_modified = _datetime_from_http_date(last_modified_str)
     return _saved_model(path, type, mimetype, last_modified)
 
 
@@ -524,10 +683,16 @@ def _increment_filename(context, filename, path='', insert=''):
     basename, dot, ext = filename.partition('.')
     suffix = dot + ext
 
+    keys, directories = yield _list_immediate_child_keys_and_directories(
+        context, _directory_key_prefix(context, path))
+    existing_names = \
+        {_final_path_component(key) for (key, _, _) in keys} | \
+        {_final_path_component(directory) for directory in directories}
+
     for i in itertools.count():
         insert_i = f'{insert}{i}' if i else ''
         name = f'{basename}{insert_i}{suffix}'
-        if not (yield _exists(context, f'/{path}/{name}')):
+        if name not in existing_names:
             break
     return name
 
@@ -545,7 +710,7 @@ def _create_checkpoint(context, path):
 
     checkpoint_id = str(int(time.time() * 1000000))
     checkpoint_path = _checkpoint_path(path, checkpoint_id)
-    yield SAVERS[(type, format)](context, None, content, checkpoint_path)
+    yield _save_any(context, None, *PREPARERS[(type, format)](content, checkpoint_path))
     # This is a new object, so shouldn't be any eventual consistency issues
     checkpoint = yield GETTERS[(type, format)](context, checkpoint_path, False)
     return {
@@ -583,19 +748,26 @@ def _list_checkpoints(context, path):
             'id': key[(key.rfind('/' + CHECKPOINT_SUFFIX + '/') + len('/' + CHECKPOINT_SUFFIX + '/')):],
             'last_modified': last_modified,
         }
-        for key, last_modified in keys
+        for key, last_modified, _ in keys
     ]
 
 
 @gen.coroutine
 def _rename(context, old_path, new_path):
-    if (not (yield _exists(context, old_path))):
+    old_file_response, old_dir_exists, new_exists = yield gen.multi([
+        _file_response(context, old_path),
+        _dir_exists(context, old_path),
+        _exists(context, new_path),
+    ])
+    old_exists = old_file_response is not None or old_dir_exists
+    type = _type_from_path_and_dir_exists(old_path, old_dir_exists)
+
+    if not old_exists:
         raise HTTPServerError(400, "Source does not exist")
 
-    if (yield _exists(context, new_path)):
+    if new_exists:
         raise HTTPServerError(400, "Target already exists")
 
-    type = yield _type_from_path(context, old_path)
     old_key = _key(context, old_path)
     new_key = _key(context, new_path)
 
@@ -604,28 +776,43 @@ def _rename(context, old_path, new_path):
 
     object_key = \
         [] if type == 'directory' else \
-        [(old_key, new_key)]
+        [(old_key, new_key, int(old_file_response.headers['Content-Length']))]
 
     renames = object_key + [
-        (key, replace_key_prefix(key))
-        for (key, _) in (yield _list_all_descendant_keys(context, old_key + '/'))
+        (key, replace_key_prefix(key), size)
+        for (key, _, size) in (yield _list_all_descendant_keys(context, old_key + '/'))
     ]
 
     # We can't really do a transaction on S3, and not sure if we can trust that on any error
     # from DELETE, that the DELETE hasn't happened: even checking if the file is still there
     # isn't bulletproof due to eventual consistency. So we risk duplicate files over risking
-    # deleted files
-    for (old_key, new_key) in object_key + sorted(renames, key=lambda k: _copy_sort_key(k[0])):
-        yield _copy_key(context, old_key, new_key)
-
-    for (old_key, _) in sorted(renames, key=lambda k: _delete_sort_key(k[0])) + object_key:
-        yield _delete_key(context, old_key)
+    # deleted files. Keys with equal sort keys don't depend on each other, so are copied
+    # concurrently
+    copies = sorted(renames, key=lambda k: _copy_sort_key(k[0]))
+    for _, copies_group in itertools.groupby(copies, key=lambda k: _copy_sort_key(k[0])):
+        yield _map_concurrently(_copy_key, [
+            (context, old_key, new_key, size)
+            for (old_key, new_key, size) in copies_group
+        ])
+
+    yield _delete_keys(context, [
+        old_key
+        for (old_key, _, _) in sorted(renames, key=lambda k: _delete_sort_key(k[0]))
+    ])
 
     return (yield _get(context, new_path, content=False, type=None, format=None))
 
 
 @gen.coroutine
-def _copy_key(context, old_key, new_key):
+def _copy_key(context, old_key, new_key, size):
+    if size < MULTIPART_COPY_THRESHOLD:
+        yield _copy_key_single(context, old_key, new_key)
+    else:
+        yield _copy_key_multipart(context, old_key, new_key, size)
+
+
+@gen.coroutine
+def _copy_key_single(context, old_key, new_key):
     source_bucket = context.s3_bucket
     copy_headers = {
         'x-amz-copy-source': f'/{source_bucket}/{old_key}',
@@ -633,12 +820,92 @@ def _copy_key(context, old_key, new_key):
     yield _make_s3_request(context, 'PUT', '/' + new_key, {}, copy_headers, b'')
 
 
+@gen.coroutine
+def _copy_key_multipart(context, old_key, new_key, size):
+    source_bucket = context.s3_bucket
+    try:
+        response = yield _make_s3_request(context, 'POST', '/' + new_key, {'uploads': ''}, {}, b'',
+                                          retry_codes=NON_IDEMPOTENT_RETRY_CODES)
+    except HTTPClientError as exception:
+        # S3 may have started an upload, but we don't have its ID
+        if exception.code in RETRY_CODES:
+            yield _abort_multipart_uploads(context, new_key)
+        raise
+    upload_id = ET.fromstring(response.body).findtext(f'{S3_NAMESPACE}UploadId')
+
+    # Parts are larger than usual for objects that would otherwise need more
+    # than S3's maximum number of parts
+    part_size = max(MULTIPART_COPY_PART_SIZE, -(-size // MAX_MULTIPART_PARTS))
+
+    @gen.coroutine
+    def copy_part(part_number, first_byte, last_byte):
+        query = {
+            'partNumber': str(part_number),
+            'uploadId': upload_id,
+        }
+        copy_headers = {
+            'x-amz-copy-source': f'/{source_bucket}/{old_key}',
+            'x-amz-copy-source-range': f'bytes={first_byte}-{last_byte}',
+        }
+        response = yield _make_s3_request(context, 'PUT', '/' + new_key, query, copy_headers, b'')
+
+        # Failures can be reported in a 200 response
+        etag = ET.fromstring(response.body).findtext(f'{S3_NAMESPACE}ETag')
+        if etag is None:
+            context.logger.warning(response.body)
+            raise HTTPServerError(500, 'Error copying S3 object')
+        return etag
+
+    try:
+        etags = yield _map_concurrently(copy_part, [
+            (part_number, first_byte, min(first_byte + part_size, size) - 1)
+            for part_number, first_byte in enumerate(range(0, size, part_size), 1)
+        ], concurrency=MAX_CONCURRENT_PART_COPIES)
+
+        complete = ET.Element('CompleteMultipartUpload')
+        for part_number, etag in enumerate(etags, 1):
+            part = ET.SubElement(complete, 'Part')
+            ET.SubElement(part, 'PartNumber').text = str(part_number)
+            ET.SubElement(part, 'ETag').text = etag
+        response = yield _make_s3_request(context, 'POST', '/' + new_key, {'uploadId': upload_id}, {}, ET.tostring(complete))
+
+        if ET.fromstring(response.body).tag == 'Error':
+            context.logger.warning(response.body)
+            raise HTTPServerError(500, 'Error copying S3 object')
+    except Exception:
+        # Otherwise S3 keeps, and charges for, the parts copied so far. A
+        # failure to abort is only logged, so the original error is raised
+        try:
+            yield _make_s3_request(context, 'DELETE', '/' + new_key, {'uploadId': upload_id}, {}, b'')
+        except Exception as exception:
+            context.logger.warning(f'Error aborting S3 multipart upload {upload_id}: {exception}')
+        raise
+
+
+@gen.coroutine
+def _abort_multipart_uploads(context, key):
+    query = {
+        'uploads': '',
+        'prefix': key,
+    }
+    response = yield _make_s3_request(context, 'GET', '/', query, {}, b'')
+    upload_ids = [
+        upload.findtext(f'{S3_NAMESPACE}UploadId')
+        for upload in ET.fromstring(response.body).iter(f'{S3_NAMESPACE}Upload')
+        if upload.findtext(f'{S3_NAMESPACE}Key') == key
+    ]
+    yield _map_concurrently(_make_s3_request, [
+        (context, 'DELETE', '/' + key, {'uploadId': upload_id}, {}, b'')
+        for upload_id in upload_ids
+    ])
+
+
 @gen.coroutine
 def _delete(context, path):
     if not path:
         raise HTTPServerError(400, "Can't delete root")
 
-    type = _type_from_path(context, path)
+    type = yield _type_from_path(context, path)
     root_key = _key(context, path)
 
     object_key = \
@@ -647,16 +914,50 @@ def _delete(context, path):
 
     descendant_keys = [
         key
-        for (key, _) in (yield _list_all_descendant_keys(context, root_key + '/'))
+        for (key, _, _) in (yield _list_all_descendant_keys(context, root_key + '/'))
     ]
 
-    for key in sorted(descendant_keys, key=_delete_sort_key) + object_key:
-        yield _delete_key(context, key)
+    yield _delete_keys(context, sorted(descendant_keys, key=_delete_sort_key) + object_key)
 
 
 @gen.coroutine
-def _delete_key(context, key):
-    yield _make_s3_request(context, 'DELETE', '/' + key, {}, {}, b'')
+def _delete_keys(context, keys):
+    # Each batch is a single "Delete Multiple Objects" request, so the order
+    # of keys is only respected between batches
+    for i in range(0, len(keys), MAX_DELETE_KEYS):
+        delete = ET.Element('Delete')
+        ET.SubElement(delete, 'Quiet').text = 'true'
+        for key in keys[i:i + MAX_DELETE_KEYS]:
+            ET.SubElement(ET.SubElement(delete, 'Object'), 'Key').text = key
+        payload = ET.tostring(delete)
+        delete_headers = {
+            'content-md5': base64.b64encode(_md5(payload).digest()).decode('utf-8'),
+        }
+        response = yield _make_s3_request(context, 'POST', '/', {'delete': ''}, delete_headers, payload)
+
+        # Failures of individual keys are reported in a 200 response
+        if ET.fromstring(response.body).find(f'{S3_NAMESPACE}Error') is not None:
+            context.logger.warning(response.body)
+            raise HTTPServerError(500, 'Error deleting S3 objects')
+
+
+# Content-MD5 is an integrity check rather than for security, which also
+# allows it on FIPS-restricted builds of OpenSSL
+_md5 = \
+    functools.partial(hashlib.md5, usedforsecurity=False) if sys.version_info >= (3, 9) else \
+    hashlib.md5
+
+
+@gen.coroutine
+def _map_concurrently(func, args_list, concurrency=MAX_CONCURRENT_REQUESTS):
+    semaphore = Semaphore(concurrency)
+
+    @gen.coroutine
+    def _func(args):
+        with (yield semaphore.acquire()):
+            return (yield func(*args))
+
+    return (yield gen.multi([_func(args) for args in args_list]))
 
 
 @gen.coroutine
@@ -708,10 +1009,6 @@ def _new(context, model, path):
 
 @gen.coroutine
 def _copy(context, from_path, to_path):
-    model = yield _get(context, from_path, content=False, type=None, format=None)
-    if model['type'] == 'directory':
-        raise HTTPServerError(400, "Can't copy directories")
-
     from_dir, from_name = \
         from_path.rsplit('/', 1) if '/' in from_path else \
         ('', from_path)
@@ -720,16 +1017,23 @@ def _copy(context, from_path, to_path):
         to_path if to_path is not None else \
         from_dir
 
-    if (yield _dir_exists(context, to_path)):
-        copy_pat = re.compile(r'\-Copy\d*\.')
-        name = copy_pat.sub(u'.', from_name)
+    model, to_dir_exists = yield gen.multi([
+        _get(context, from_path, content=False, type=None, format=None),
+        _dir_exists(context, to_path),
+    ])
+
+    if model['type'] == 'directory':
+        raise HTTPServerError(400, "Can't copy directories")
+
+    if to_dir_exists:
+        name = _strip_copy_suffix(from_name)
         to_name = yield _increment_filename(context, name, to_path, insert='-Copy')
         to_path = u'{0}/{1}'.format(to_path, to_name)
 
     from_key = _key(context, from_path)
     to_key = _key(context, to_path)
 
-    yield _copy_key(context, from_key, to_key)
+    yield _copy_key(context, from_key, to_key, model['size'])
     return {
         **model,
         'name': to_name,
@@ -737,6 +1041,15 @@ def _copy(context, from_path, to_path):
     }
 
 
+_COPY_REGEX = re.compile(r'\-Copy\d*\.')
+
+
+def _strip_copy_suffix(name):
+    return \
+        _COPY_REGEX.sub(u'.', name) if '-Copy' in name else \
+        name
+
+
 @gen.coroutine
 def _list_immediate_child_keys_and_directories(context, key_prefix):
     return (yield _list_keys(context, key_prefix, '/'))
@@ -762,7 +1075,7 @@ def _list_keys(context, key_prefix, delimeter):
             'prefix': key_prefix,
         }
         response = yield _make_s3_request(context, 'GET', '/', query, {}, b'')
-        return _parse_list_response(response)
+        return ET.fromstring(response.body)
 
     @gen.coroutine
     def _list_later_page(token):
@@ -771,152 +1084,296 @@ def _list_keys(context, key_prefix, delimeter):
             'continuation-token': token,
         }
         response = yield _make_s3_request(context, 'GET', '/', query, {}, b'')
-        return _parse_list_response(response)
+        return ET.fromstring(response.body)
 
-    def _first_child_text(el, tag):
-        for child in el:
-            if child.tag == tag:
-                return child.text
+    contents_tag = f'{S3_NAMESPACE}Contents'
+    key_tag = f'{S3_NAMESPACE}Key'
+    last_modified_tag = f'{S3_NAMESPACE}LastModified'
+    size_tag = f'{S3_NAMESPACE}Size'
+    common_prefixes_tag = f'{S3_NAMESPACE}CommonPrefixes'
+    prefix_tag = f'{S3_NAMESPACE}Prefix'
+    next_continuation_token_tag = f'{S3_NAMESPACE}NextContinuationToken'
 
-    def _parse_list_response(response):
-        namespace = '{http://s3.amazonaws.com/doc/2006-03-01/}'
-        root = ET.fromstring(response.body)
-        next_token = ''
+    def _parse_list_response(root):
         keys = []
         directories = []
         for el in root:
-            if el.tag == f'{namespace}Contents':
-                key = _first_child_text(el, f'{namespace}Key')
-                last_modified_str = _first_child_text(el, f'{namespace}LastModified')
-                last_modified = datetime.datetime.strptime(last_modified_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-                keys.append((key, last_modified))
-            if el.tag == f'{namespace}CommonPrefixes':
+            if el.tag == contents_tag:
+                key = el.findtext(key_tag)
+                last_modified_str = el.findtext(last_modified_tag)
+                last_modified = _datetime_from_iso_8601(last_modified_str)
+                size = int(el.findtext(size_tag))
+                keys.append((key, last_modified, size))
+            elif el.tag == common_prefixes_tag:
                 # Prefixes end in '/', which we strip off
-                directories.append(_first_child_text(el, f'{namespace}Prefix')[:-1])
-            if el.tag == f'{namespace}NextContinuationToken':
-                next_token = el.text
-
-        return (next_token, keys, directories)
-
-    token, keys, directories = yield _list_first_page()
-    while token:
-        token, keys_page, directories_page = yield _list_later_page(token)
+                directories.append(el.findtext(prefix_tag)[:-1])
+
+        return (keys, directories)
+
+    # Each page's XML is parsed on the loop, but its elements are walked into
+    # keys and directories in a thread while the next page is requested. The
+    # last, often only, page is walked directly, since there's nothing to wait for
+    keys = []
+    directories = []
+    next_page = _list_first_page()
+    while next_page is not None:
+        root = yield next_page
+        token = root.findtext(next_continuation_token_tag)
+        next_page = _list_later_page(token) if token else None
+        if next_page is None:
+            keys_page, directories_page = _parse_list_response(root)
+        else:
+            try:
+                keys_page, directories_page = yield IOLoop.current().run_in_executor(None, _parse_list_response, root)
+            except Exception:
+                # Otherwise a failure to fetch the next page is logged as never retrieved
+                next_page.add_done_callback(lambda future: future.exception())
+                raise
         keys.extend(keys_page)
         directories.extend(directories_page)
 
     return keys, directories
 
 
+# The AsyncHTTPClient instance shared on each IOLoop ignores its arguments if
+# something else in the process created it first, so we keep our own. Each is
+# bound to the IOLoop it's created on, so there is one per IOLoop
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def _http_client():
+    io_loop = IOLoop.current()
+    if io_loop not in _http_clients:
+        _http_clients[io_loop] = HTTPClient(
+            force_instance=True,
+            max_clients=HTTP_CLIENT_MAX_CLIENTS,
+            defaults=HTTP_CLIENT_DEFAULTS,
+        )
+    return _http_clients[io_loop]
+
+
 @gen.coroutine
-def _make_s3_request(context, method, path, query, api_pre_auth_headers, payload):
+def _make_s3_request(context, method, path, query, api_pre_auth_headers, payload,
+                     retry_codes=RETRY_CODES):
     service = 's3'
     credentials = yield context.s3_auth()
-    pre_auth_headers = {
-        **api_pre_auth_headers,
-        **credentials.pre_auth_headers,
-    }
     full_path = f'/{context.s3_bucket}{path}'
+    querystring = _querystring(query)
+    encoded_path = _quote_path(full_path)
     headers = _aws_sig_v4_headers(
-        credentials.access_key_id, credentials.secret_access_key, pre_auth_headers,
-        service, context.region, context.s3_host, method, full_path, query, payload,
+        credentials.access_key_id, credentials.secret_access_key,
+        credentials.pre_auth_headers, api_pre_auth_headers,
+        service, context.region, context.s3_host, method, encoded_path, querystring, payload,
     )
 
-    querystring = urllib.parse.urlencode(query, safe='~', quote_via=urllib.parse.quote)
-    encoded_path = urllib.parse.quote(full_path, safe='/~')
     url = f'https://{context.s3_host}{encoded_path}' + (('?' + querystring) if querystring else '')
 
     body = \
-        payload if method == 'PUT' else \
+        payload if method in ('PUT', 'POST') else \
         None
     request = HTTPRequest(url, method=method, headers=headers, body=body)
 
     try:
-        response = (yield AsyncHTTPClient().fetch(request))
+        response = (yield _fetch_with_retry(request, retry_codes))
     except HTTPClientError as exception:
-        if exception.response.code != 404:
-            context.logger.warning(exception.response.body)
+        if exception.code != 404:
+            context.logger.warning(exception.response.body if exception.response else exception)
         raise
 
     return response
 
 
-def _aws_sig_v4_headers(access_key_id, secret_access_key, pre_auth_headers,
-                        service, region, host, method, path, query, payload):
+# The path and querystring are the quoted forms used in the URL, which is
+# what the canonical request needs
+def _aws_sig_v4_headers(access_key_id, secret_access_key,
+                        credentials_pre_auth_headers, api_pre_auth_headers,
+                        service, region, host, method, encoded_path, querystring, payload):
     algorithm = 'AWS4-HMAC-SHA256'
 
-    now = datetime.datetime.utcnow()
-    amzdate = now.strftime('%Y%m%dT%H%M%SZ')
-    datestamp = now.strftime('%Y%m%d')
-    payload_hash = hashlib.sha256(payload).hexdigest()
+    amzdate = '%04d%02d%02dT%02d%02d%02dZ' % time.gmtime()[:6]
+    datestamp = amzdate[:8]
+    payload_hash = \
+        hashlib.sha256(payload).hexdigest() if payload else \
+        EMPTY_PAYLOAD_SHA256
     credential_scope = f'{datestamp}/{region}/{service}/aws4_request'
 
-    pre_auth_headers_lower = {
-        header_key.lower(): ' '.join(header_value.split())
-        for header_key, header_value in pre_auth_headers.items()
-    }
+    # The credentials' headers take precedence over the API's
+    credentials_pre_auth_headers_lower = \
+        _normalized_pre_auth_headers(frozenset(credentials_pre_auth_headers.items()))
+    pre_auth_headers_lower = \
+        {**_normalized_headers(api_pre_auth_headers.items()), **credentials_pre_auth_headers_lower} if api_pre_auth_headers else \
+        credentials_pre_auth_headers_lower
     required_headers = {
         'host': host,
         'x-amz-content-sha256': payload_hash,
         'x-amz-date': amzdate,
     }
     headers = {**pre_auth_headers_lower, **required_headers}
-    header_keys = sorted(headers.keys())
-    signed_headers = ';'.join(header_keys)
-
-    def signature():
-        def canonical_request():
-            canonical_uri = urllib.parse.quote(path, safe='/~')
-            quoted_query = sorted(
-                (urllib.parse.quote(key, safe='~'), urllib.parse.quote(value, safe='~'))
-                for key, value in query.items()
-            )
-            canonical_querystring = '&'.join(f'{key}={value}' for key, value in quoted_query)
-            canonical_headers = ''.join(f'{key}:{headers[key]}\n' for key in header_keys)
-
-            return f'{method}\n{canonical_uri}\n{canonical_querystring}\n' + \
-                   f'{canonical_headers}\n{signed_headers}\n{payload_hash}'
-
-        def sign(key, msg):
-            return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-
-        string_to_sign = f'{algorithm}\n{amzdate}\n{credential_scope}\n' + \
-                         hashlib.sha256(canonical_request().encode('utf-8')).hexdigest()
+    header_keys, signed_headers = _signed_header_keys(frozenset(pre_auth_headers_lower))
 
-        date_key = sign(('AWS4' + secret_access_key).encode('utf-8'), datestamp)
-        region_key = sign(date_key, region)
-        service_key = sign(region_key, service)
-        request_key = sign(service_key, 'aws4_request')
-        return sign(request_key, string_to_sign).hex()
+    canonical_request = _canonical_request(
+        method, encoded_path, querystring, header_keys, headers, signed_headers, payload_hash,
+    )
+    string_to_sign = '\n'.join((
+        algorithm, amzdate, credential_scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ))
+    request_key = _signing_key(secret_access_key, datestamp, region, service)
+    request_signature = _sign(request_key, string_to_sign).hex()
 
     return {
-        **pre_auth_headers,
+        **api_pre_auth_headers,
+        **credentials_pre_auth_headers,
         'x-amz-date': amzdate,
         'x-amz-content-sha256': payload_hash,
         'Authorization': f'{algorithm} Credential={access_key_id}/{credential_scope}, '
-                         f'SignedHeaders={signed_headers}, Signature=' + signature(),
+                         f'SignedHeaders={signed_headers}, Signature={request_signature}',
     }
 
 
-def _run_sync_in_new_thread(func):
-    result = None
-    exception = None
-    def _func():
-        nonlocal result
-        nonlocal exception
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        try:
-            result = IOLoop.current().run_sync(func)
-        except BaseException as _exception:
-            exception = _exception
+def _canonical_request(method, encoded_path, querystring, header_keys, headers,
+                       signed_headers, payload_hash):
+    canonical_headers = ''.join([f'{key}:{headers[key]}\n' for key in header_keys])
+
+    return '\n'.join((
+        method, encoded_path, querystring,
+        canonical_headers, signed_headers, payload_hash,
+    ))
 
-    thread = threading.Thread(target=_func)
-    thread.start()
-    thread.join()
 
-    if exception is not None:
-        raise exception
-    else:
-        return result
+# The credentials' pre-auth headers are the same for many requests, so are
+# only normalized once. The API's, such as x-amz-copy-source, are often
+# different for each request, so aren't cached. The returned dict is
+# shared, so must not be modified
+@functools.lru_cache(maxsize=16)
+def _normalized_pre_auth_headers(pre_auth_headers_items):
+    return _normalized_headers(pre_auth_headers_items)
+
+
+def _normalized_headers(headers_items):
+    return {
+        header_key.lower(): _normalize_header_value(header_value)
+        for header_key, header_value in headers_items
+    }
+
+
+# The required headers are always the same, so the sorted header names
+# depend only on the rarely changing pre-auth header names
+@functools.lru_cache(maxsize=16)
+def _signed_header_keys(pre_auth_header_keys):
+    header_keys = tuple(sorted(
+        pre_auth_header_keys | {'host', 'x-amz-content-sha256', 'x-amz-date'}
+    ))
+    return header_keys, ';'.join(header_keys)
+
+
+# Header values rarely have whitespace to collapse, and checking that is
+# cheaper than splitting and joining. Any whitespace other than a single
+# inner space needs collapsing
+_COLLAPSIBLE_WHITESPACE_REGEX = re.compile(r'\s\s|[^\S ]|^\s|\s$')
+
+
+def _normalize_header_value(header_value):
+    return \
+        ' '.join(header_value.split()) if _COLLAPSIBLE_WHITESPACE_REGEX.search(header_value) else \
+        header_value
+
+
+# Most requests have no payload
+EMPTY_PAYLOAD_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+# Most paths need no quoting, and checking that is much cheaper than quoting.
+# The same paths are often requested repeatedly, such as a notebook's on
+# each save, so those that do need quoting are cached
+_UNQUOTED_PATH_REGEX = re.compile(r'[A-Za-z0-9_.\-~/]*')
+
+
+@functools.lru_cache(maxsize=1024)
+def _quote_path(path):
+    return \
+        path if _UNQUOTED_PATH_REGEX.fullmatch(path) else \
+        urllib.parse.quote(path, safe='/~')
+
+
+# Sorted as required for signing, which is also valid for the URL
+def _querystring(query):
+    if not query:
+        return ''
+
+    quoted_query = sorted(
+        (urllib.parse.quote(key, safe='~'), urllib.parse.quote(value, safe='~'))
+        for key, value in query.items()
+    )
+    return '&'.join(f'{key}={value}' for key, value in quoted_query)
+
+
+# The signing key only changes daily, so is derived once for many requests
+@functools.lru_cache(maxsize=8)
+def _signing_key(secret_access_key, datestamp, region, service):
+    date_key = _sign(('AWS4' + secret_access_key).encode('utf-8'), datestamp)
+    region_key = _sign(date_key, region)
+    service_key = _sign(region_key, service)
+    return _sign(service_key, 'aws4_request')
+
+
+def _sign(key, msg):
+    return hmac.digest(key, msg.encode('utf-8'), 'sha256')
+
+
+# A single long-lived thread and event loop runs the coroutines that have to be
+# waited on synchronously. If the HTTP client reuses connections, it also makes
+# every request to S3, so they all share one client and its connections.
+# Otherwise there are no connections to share, so requests are made from
+# whichever loop they're on
+_loop_thread_loop = None
+_loop_thread_lock = threading.Lock()
+
+
+def _get_loop_thread_loop():
+    global _loop_thread_loop
+
+    def _run_forever(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    with _loop_thread_lock:
+        if _loop_thread_loop is None:
+            _loop_thread_loop = asyncio.new_event_loop()
+            threading.Thread(target=_run_forever, args=(_loop_thread_loop,), daemon=True).start()
+
+    return _loop_thread_loop
+
+
+def _run_in_loop_thread(func):
+    async def _func():
+        return await func()
+
+    return asyncio.run_coroutine_threadsafe(_func(), _get_loop_thread_loop())
+
+
+def _run_sync_in_loop_thread(func):
+    return _run_in_loop_thread(func).result()
+
+
+def _fetch(request):
+    in_other_loop = \
+        HTTP_CLIENT_REUSES_CONNECTIONS and \
+        asyncio.get_running_loop() is not _get_loop_thread_loop()
+    return \
+        asyncio.wrap_future(_run_in_loop_thread(lambda: _http_client().fetch(request))) if in_other_loop else \
+        _http_client().fetch(request)
+
+
+@gen.coroutine
+def _fetch_with_retry(request, retry_codes):
+    for attempt in itertools.count():
+        try:
+            return (yield _fetch(request))
+        except HTTPClientError as exception:
+            if exception.code not in retry_codes or attempt == MAX_RETRIES:
+                raise
+        yield gen.sleep(min(4, 0.25 * 2 ** attempt))
 
 
 GETTERS = {
@@ -927,9 +1384,9 @@ GETTERS = {
 }
 
 
-SAVERS = {
-    ('notebook', 'json'): _save_notebook,
-    ('file', 'text'): _save_file_text,
-    ('file', 'base64'):  _save_file_base64,
-    ('directory', 'json'): _save_directory,
+PREPARERS = {
+    ('notebook', 'json'): _prepare_notebook,
+    ('file', 'text'): _prepare_file_text,
+    ('file', 'base64'):  _prepare_file_base64,
+    ('directory', 'json'): _prepare_directory,
 }